@@ -16,85 +16,119 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import functools
 import os
-
-import mock
+from collections import namedtuple
 
 from twisted.internet import defer
 from twisted.internet import reactor
 from twisted.python import log
-from twisted.python.filepath import FilePath
 
 from buildbot import util
 from buildbot.clients import tryclient
+from buildbot.config import BuilderConfig
+from buildbot.process import results
+from buildbot.process.buildstep import BuildStep
+from buildbot.process.factory import BuildFactory
 from buildbot.schedulers import trysched
 from buildbot.test.util import www
 from buildbot.test.util.integration import RunMasterBase
 
 
-# wait for some asynchronous result
+class MyBuildStep(BuildStep):
+
+    def start(self):
+        self.finished(results.SUCCESS)
+
+
+# the factory is not mutated once the master has loaded it, so all of the
+# generated configs can share a single instance
+_factory = BuildFactory()
+_factory.addStep(MyBuildStep(name='one'))
+_factory.addStep(MyBuildStep(name='two'))
+
+
+# wait for some asynchronous result; this is a generic fallback for
+# conditions that have no notification hook we can subscribe to
 @defer.inlineCallbacks
 def waitFor(fn):
+    delay = 0
     while True:
         res = yield fn()
         if res:
             defer.returnValue(res)
-        yield util.asyncSleep(.01)
+        # most conditions come true within a reactor tick or two, so begin
+        # by just yielding to the reactor and back off towards a 10ms poll
+        # for the slow ones
+        yield util.asyncSleep(delay)
+        delay = min(delay * 2 + .0001, .01)
+
+
+# replacements for the patched functions, defined at module level both to
+# avoid rebuilding the closures in every setUp and to give them stable
+# qualnames in profiles; each takes the test case as its first argument
+
+# the status object handed to processEnded; every fake try process exits
+# successfully, so one shared instance suffices
+_ProcessStatus = namedtuple('_ProcessStatus', ['value'])
+_ExitInfo = namedtuple('_ExitInfo', ['signal', 'exitCode'])
+_SUCCESS_STATUS = _ProcessStatus(value=_ExitInfo(signal=None, exitCode=0))
+
+
+def _spawnProcess(test, pp, executable, args, environ):
+    tmpfile = os.path.join(test.jobdir, 'tmp', 'testy')
+    newfile = os.path.join(test.jobdir, 'new', 'testy')
+    with open(tmpfile, "w") as f:
+        f.write(pp.job)
+    os.rename(tmpfile, newfile)
+    # pass the format through to log.msg, so the string is only
+    # interpolated if an observer actually records it
+    log.msg(format="wrote jobfile %(newfile)s", newfile=newfile)
+    # get the scheduler to poll this directory now
+    d = test.sch.watcher.poll()
+    d.addErrback(log.err, 'while polling')
+
+    def finished(_):
+        pp.processEnded(_SUCCESS_STATUS)
 
+    if d.called:
+        # the poll often completes synchronously; finish the fake
+        # process in the same tick rather than bouncing through the
+        # reactor
+        finished(None)
+    else:
+        d.addCallback(finished)
 
-class Schedulers(RunMasterBase, www.RequiresWwwMixin):
+
+def _getSourceStamp(vctype, treetop, branch=None, repository=None):
+    return defer.succeed(
+        tryclient.SourceStamp(branch='br', revision='rr',
+                              patch=(0, '++--')))
+
+
+def _output(test, *msg):
+    msg = ' '.join(map(str, msg))
+    log.msg(format="output: %(msg)s", msg=msg)
+    test.output.append(msg)
+
+
+class TryClientBase(RunMasterBase, www.RequiresWwwMixin):
 
     def setUp(self):
         self.master = None
         self.sch = None
 
-        def spawnProcess(pp, executable, args, environ):
-            tmpfile = os.path.join(self.jobdir, 'tmp', 'testy')
-            newfile = os.path.join(self.jobdir, 'new', 'testy')
-            with open(tmpfile, "w") as f:
-                f.write(pp.job)
-            os.rename(tmpfile, newfile)
-            log.msg("wrote jobfile %s" % newfile)
-            # get the scheduler to poll this directory now
-            d = self.sch.watcher.poll()
-            d.addErrback(log.err, 'while polling')
-
-            @d.addCallback
-            def finished(_):
-                st = mock.Mock()
-                st.value.signal = None
-                st.value.exitCode = 0
-                pp.processEnded(st)
-
-        self.patch(reactor, 'spawnProcess', spawnProcess)
-
-        def getSourceStamp(vctype, treetop, branch=None, repository=None):
-            return defer.succeed(
-                tryclient.SourceStamp(branch='br', revision='rr',
-                                      patch=(0, '++--')))
-        self.patch(tryclient, 'getSourceStamp', getSourceStamp)
+        self.patch(reactor, 'spawnProcess',
+                   functools.partial(_spawnProcess, self))
+        self.patch(tryclient, 'getSourceStamp', _getSourceStamp)
 
         self.output = []
 
         # stub out printStatus, as it's timing-based and thus causes
         # occasional test failures.
         self.patch(tryclient.Try, 'printStatus', lambda _: None)
+        self.patch(tryclient, 'output', functools.partial(_output, self))
 
-        def output(*msg):
-            msg = ' '.join(map(str, msg))
-            log.msg("output: %s" % msg)
-            self.output.append(msg)
-        self.patch(tryclient, 'output', output)
-
-    def setupJobdir(self):
-        jobdir = FilePath(self.mktemp())
-        jobdir.createDirectory()
-        self.jobdir = jobdir.path
-        for sub in 'new', 'tmp', 'cur':
-            jobdir.child(sub).createDirectory()
-        return self.jobdir
-
-    @defer.inlineCallbacks
     def startMaster(self, sch):
         extra_config = {
             'schedulers': [sch],
@@ -102,29 +136,51 @@ class Schedulers(RunMasterBase, www.RequiresWwwMixin):
         }
         self.sch = sch
 
-        yield self.setupConfig(masterConfig(extra_config))
-
-        # wait until the scheduler is active
-        yield waitFor(lambda: self.sch.active)
-
-        # and, for Try_Userpass, until it's registered its port
-        if isinstance(self.sch, trysched.Try_Userpass):
-            def getSchedulerPort():
-                if not self.sch.registrations:
-                    return
-                self.serverPort = self.sch.registrations[0].getPort()
-                log.msg("Scheduler registered at port %d" % self.serverPort)
-                return True
-            yield waitFor(getSchedulerPort)
+        # subscribe to the scheduler's activation, rather than polling its
+        # 'active' flag: by the time the activation hook runs, the flag is
+        # already set, so firing a Deferred from it wakes us immediately
+        sch._activeDeferred = defer.Deferred()
+        oldActivate = sch.activate
+
+        def activate():
+            sch._activeDeferred.callback(None)
+            return oldActivate()
+        sch.activate = activate
+
+        d = self.setupConfig(masterConfig(extra_config))
+
+        # wait until the scheduler is active and, for Try_Userpass, until
+        # it's registered its port; the two conditions resolve
+        # independently, so wait for both concurrently
+        def waitReady(_):
+            waits = [sch._activeDeferred]
+            if isinstance(sch, trysched.Try_Userpass):
+                def getSchedulerPort():
+                    if not self.sch.registrations:
+                        return
+                    self.serverPort = self.sch.registrations[0].getPort()
+                    log.msg("Scheduler registered at port %d" %
+                            self.serverPort)
+                    return True
+                waits.append(waitFor(getSchedulerPort))
+            return defer.gatherResults(waits)
+        d.addCallback(waitReady)
+        return d
 
     def runClient(self, config):
         self.clt = tryclient.Try(config)
         return self.clt.run(_inTests=True)
 
+
+class TryUserpass(TryClientBase):
+
+    def startTryMaster(self):
+        return self.startMaster(
+            trysched.Try_Userpass('try', ['a'], 0, [('u', b'p')]))
+
     @defer.inlineCallbacks
     def test_userpass_no_wait(self):
-        yield self.startMaster(
-            trysched.Try_Userpass('try', ['a'], 0, [('u', b'p')]))
+        yield self.startTryMaster()
         yield self.runClient({
             'connect': 'pb',
             'master': '127.0.0.1:%s' % self.serverPort,
@@ -143,8 +199,7 @@ class Schedulers(RunMasterBase, www.RequiresWwwMixin):
 
     @defer.inlineCallbacks
     def test_userpass_wait(self):
-        yield self.startMaster(
-            trysched.Try_Userpass('try', ['a'], 0, [('u', b'p')]))
+        yield self.startTryMaster()
         yield self.runClient({
             'connect': 'pb',
             'master': '127.0.0.1:%s' % self.serverPort,
@@ -165,8 +220,7 @@ class Schedulers(RunMasterBase, www.RequiresWwwMixin):
 
     @defer.inlineCallbacks
     def test_userpass_list_builders(self):
-        yield self.startMaster(
-            trysched.Try_Userpass('try', ['a'], 0, [('u', b'p')]))
+        yield self.startTryMaster()
         yield self.runClient({
             'connect': 'pb',
             'get-builder-names': True,
@@ -182,10 +236,24 @@ class Schedulers(RunMasterBase, www.RequiresWwwMixin):
         buildsets = yield self.master.db.buildsets.getBuildsets()
         self.assertEqual(len(buildsets), 0)
 
+
+class TryJobdir(TryClientBase):
+
+    def setupJobdir(self):
+        self.jobdir = self.mktemp()
+        # each makedirs call creates the jobdir itself along with the first
+        # subdirectory, so no separate mkdir of the base is needed
+        for sub in 'new', 'tmp', 'cur':
+            os.makedirs(os.path.join(self.jobdir, sub))
+        return self.jobdir
+
+    def startTryMaster(self):
+        jobdir = self.setupJobdir()
+        return self.startMaster(trysched.Try_Jobdir('try', ['a'], jobdir))
+
     @defer.inlineCallbacks
     def test_jobdir_no_wait(self):
-        jobdir = self.setupJobdir()
-        yield self.startMaster(trysched.Try_Jobdir('try', ['a'], jobdir))
+        yield self.startTryMaster()
         yield self.runClient({
             'connect': 'ssh',
             'master': '127.0.0.1',
@@ -204,8 +272,7 @@ class Schedulers(RunMasterBase, www.RequiresWwwMixin):
 
     @defer.inlineCallbacks
     def test_jobdir_wait(self):
-        jobdir = self.setupJobdir()
-        yield self.startMaster(trysched.Try_Jobdir('try', ['a'], jobdir))
+        yield self.startTryMaster()
         yield self.runClient({
             'connect': 'ssh',
             'wait': True,
@@ -224,30 +291,23 @@ class Schedulers(RunMasterBase, www.RequiresWwwMixin):
         self.assertEqual(len(buildsets), 1)
 
 
-def masterConfig(extra_config):
-    c = {}
-    from buildbot.config import BuilderConfig
-    from buildbot.process.buildstep import BuildStep
-    from buildbot.process.factory import BuildFactory
-    from buildbot.process import results
+# immutable defaults shared by every generated config; the mutable fields
+# are rebuilt for each call in masterConfig below
+_BASE_CONFIG = {
+    'title': "test",
+    'titleURL': "test",
+    'buildbotURL': "http://localhost:8010/",
+}
 
-    class MyBuildStep(BuildStep):
-
-        def start(self):
-            self.finished(results.SUCCESS)
 
+def masterConfig(extra_config):
+    c = dict(_BASE_CONFIG)
     c['change_source'] = []
     c['schedulers'] = []  # filled in above
-    f1 = BuildFactory()
-    f1.addStep(MyBuildStep(name='one'))
-    f1.addStep(MyBuildStep(name='two'))
     c['builders'] = [
-        BuilderConfig(name="a", workernames=["local1"], factory=f1),
+        BuilderConfig(name="a", workernames=["local1"], factory=_factory),
     ]
     c['status'] = []
-    c['title'] = "test"
-    c['titleURL'] = "test"
-    c['buildbotURL'] = "http://localhost:8010/"
     c['mq'] = {'debug': True}
     # test wants to influence the config, but we still return a new config
     # each time